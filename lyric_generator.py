@@ -1,11 +1,22 @@
 import sys
 import os
 import re
+import shutil
 import subprocess
 import threading
+import queue
 import time
 import json 
+import multiprocessing
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
+try:
+    import fcntl # 仅 Linux/macOS，用于调整管道缓冲大小
+except ImportError:
+    fcntl = None
 from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageEnhance
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QLabel, QPushButton, QSlider, QFileDialog, QColorDialog, 
@@ -42,6 +53,11 @@ def get_ffmpeg_path():
     return ffmpeg_exe
 
 class LrcParser:
+    # 时间标签 [mm:ss.xx] 或 [mm:ss.xxx]
+    time_pattern = re.compile(r'\[(\d{2}):(\d{2})\.(\d{2,3})\]')
+    # 带时间标签的一行：标签前内容 / 第一个时间标签 / 标签后内容
+    line_pattern = re.compile(r'^(.*?)\[(\d{2}):(\d{2})\.(\d{2,3})\](.*)$', re.MULTILINE)
+
     @staticmethod
     def parse(file_path):
         lyrics = []
@@ -49,75 +65,175 @@ class LrcParser:
             return lyrics
         
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
+            content = f.read()
             
-        time_pattern = re.compile(r'\[(\d{2}):(\d{2})\.(\d{2,3})\]')
-        
-        for line in lines:
-            line = line.strip()
-            match = time_pattern.search(line)
-            if match:
-                mm, ss, ms = match.groups()
+        # 整个文件一次正则扫描，取每行第一个时间标签，其余标签从文本中去掉
+        time_sub = LrcParser.time_pattern.sub
+        for head, mm, ss, ms, tail in LrcParser.line_pattern.findall(content):
+            text = head + tail
+            if '[' in text: text = time_sub('', text) # 大多数行只有一个时间标签
+            text = text.strip()
+            if text:
                 # 统一转为秒
                 ms_val = int(ms)
                 if len(ms) == 2: ms_val *= 10
-                
-                total_seconds = int(mm) * 60 + int(ss) + ms_val / 1000.0
-                text = time_pattern.sub('', line).strip()
-                if text:
-                    lyrics.append({'time': total_seconds, 'text': text})
+                lyrics.append({'time': int(mm) * 60 + int(ss) + ms_val / 1000.0, 'text': text})
         
-        # 排序
+        # 排序 (稳定排序，同一时间保持文件中的先后顺序)
         lyrics.sort(key=lambda x: x['time'])
         return lyrics
 
+@dataclass(frozen=True, slots=True)
+class RenderParams:
+    """
+    FrameRenderer 用到的渲染参数 (只读)。
+    界面和导出仍然使用参数字典，渲染器构造时转换一次，逐帧渲染时不再查字典
+    """
+    width: int
+    height: int
+    font_path: str
+    font_size: int
+    font_color: tuple
+    align: str
+    visible_lines: int
+    line_spacing: int
+    scale_decay: float
+    fade_decay: float
+    blur_base: float
+    blur_inc: float
+    meta_title: str
+    meta_artist: str
+    meta_album: str
+    shadow_enabled: bool
+    shadow_color: tuple
+    shadow_offset: tuple
+    stroke_enabled: bool
+    stroke_color: tuple
+    stroke_width: int
+
+    @classmethod
+    def from_dict(cls, params):
+        """从参数字典构造；render_scale 直接折算进尺寸 (例如预览)，不再先渲染再缩放"""
+        render_scale = params.get('render_scale', 1.0)
+        def scaled(value, minimum=1):
+            return value if render_scale == 1.0 else max(minimum, int(value * render_scale))
+
+        shadow = params['shadow']
+        stroke = params['stroke']
+        return cls(
+            width=scaled(params['width']),
+            height=scaled(params['height']),
+            font_path=params['font_path'],
+            font_size=scaled(params['font_size']),
+            font_color=tuple(params['font_color']),
+            align=params['align'],
+            visible_lines=params['visible_lines'],
+            line_spacing=scaled(params['line_spacing'], 0),
+            scale_decay=params['scale_decay'],
+            fade_decay=params['fade_decay'],
+            blur_base=params['blur_base'],
+            blur_inc=params['blur_inc'],
+            meta_title=params['meta_title'],
+            meta_artist=params['meta_artist'],
+            meta_album=params['meta_album'],
+            shadow_enabled=bool(shadow['enabled']),
+            shadow_color=tuple(shadow['color']),
+            shadow_offset=(shadow['x'], shadow['y']),
+            stroke_enabled=bool(stroke['enabled']),
+            stroke_color=tuple(stroke['color']),
+            stroke_width=stroke['width'],
+        )
+
 class FrameRenderer:
     """
     负责绘制每一帧图像的核心类
     """
+    # 光栅化结果缓存上限的下限 (LRU)，实际上限按屏幕上的槽位数放大，见 __init__
+    GLYPH_CACHE_SIZE = 64
+    # 单行临时画布四周的留白，防止模糊被切
+    TEXT_PADDING = 20
+
     def __init__(self, params, lyrics):
-        self.p = params
+        # params 可以是参数字典或 RenderParams
+        self.p = params if isinstance(params, RenderParams) else RenderParams.from_dict(params)
         self.lyrics = lyrics
+        # (歌词文本, 缩放档, 模糊档) -> 完全不透明的光栅化结果
+        self.glyph_cache = OrderedDict()
+        # 歌词文本 -> 字形包围盒，字体度量只取决于文本，量一次即可
+        self.text_bbox = {}
+        # 每行开始时间，用于二分查找当前行
+        self.line_times = np.fromiter((line['time'] for line in lyrics), dtype=np.float64, count=len(lyrics))
         # 预加载字体以提高性能
         try:
-            self.lyric_font = ImageFont.truetype(self.p['font_path'], self.p['font_size'])
-            self.meta_title_font = ImageFont.truetype(self.p['font_path'], int(self.p['font_size'] * 1.5))
-            self.meta_info_font = ImageFont.truetype(self.p['font_path'], int(self.p['font_size'] * 0.8))
+            self.lyric_font = ImageFont.truetype(self.p.font_path, self.p.font_size)
+            self.meta_title_font = ImageFont.truetype(self.p.font_path, int(self.p.font_size * 1.5))
+            self.meta_info_font = ImageFont.truetype(self.p.font_path, int(self.p.font_size * 0.8))
         except:
             self.lyric_font = ImageFont.load_default()
             self.meta_title_font = ImageFont.load_default()
             self.meta_info_font = ImageFont.load_default()
 
-    def get_current_line_index(self, current_time):
-        idx = -1
-        for i, line in enumerate(self.lyrics):
-            if current_time >= line['time']:
-                idx = i
-            else:
-                break
-        return idx
+        # 缩放/透明度/模糊只取决于与当前行的距离，与时间无关：
+        # 按距离等级一次性算好，逐帧渲染时直接查表
+        levels = np.arange(self.p.visible_lines // 2 + 2, dtype=np.float64)
+        level_scale = np.maximum(0.1, 1.0 - self.p.scale_decay * levels)
+        level_alpha = np.maximum(0, 255 - self.p.fade_decay * levels * 50)
+        level_blur = self.p.blur_base + self.p.blur_inc * levels
+        level_alpha[0] = 255 # 当前行完全不透明
+        level_blur[0] = 0 # 当前行清晰
+        # 缩放按 0.05、模糊按 0.5 分档：参数相同的等级可以共用同一份光栅化结果
+        level_scale = np.round(level_scale * 20) / 20
+        level_blur = np.round(level_blur * 2) / 2
+        self.level_scale = level_scale.tolist()
+        self.level_alpha = level_alpha.tolist()
+        self.level_blur = level_blur.tolist()
+        # 透明度随距离单调递减：超过这个等级的行太淡了不画，直接不进渲染列表
+        self.max_level = 0
+        while self.max_level + 1 < len(self.level_alpha) and self.level_alpha[self.max_level + 1] > 5:
+            self.max_level += 1
+
+        self.layout_header()
+        self.header_buf = self.render_header()
+        self.plan_lines()
+        # 可见行数/字号/行距由用户决定，屏幕上的槽位可能远多于 64 个；
+        # 缓存装不下一帧的全部行时 LRU 每次都会失效，所以按槽位数留足余量
+        self.glyph_cache_size = max(self.GLYPH_CACHE_SIZE, 2 * len(self.plan))
+
+        # 持久化的帧缓冲，逐帧复用，避免每帧重新分配整张图
+        self.frame_buf = np.zeros((self.p.height, self.p.width, 4), np.uint8)
 
-    def draw_text_with_effects(self, draw, text, x, y, font, color, alpha, scale, blur_radius, align, shadow, stroke):
-        """绘制带有各种特效的单行文本"""
-        if alpha <= 5: return None, 0, 0 #太淡了不画
-        
+    def get_current_line_index(self, current_time):
+        # 歌词已按时间排序，二分查找最后一个 time <= current_time 的行 (没有则为 -1)
+        return int(np.searchsorted(self.line_times, current_time, side='right')) - 1
+
+    def get_text_bbox(self, text):
+        """歌词字体下的文本包围盒 (带缓存)"""
+        bbox = self.text_bbox.get(text)
+        if bbox is None:
+            bbox = self.text_bbox[text] = self.lyric_font.getbbox(text)
+        return bbox
+
+    def rasterize_text(self, text, scale, blur_radius):
+        """以完全不透明的方式绘制带有各种特效的单行文本，返回 (H, W, 4) 的 RGBA 数组，透明度在贴图时再乘上去"""
+        p = self.p
+        font = self.lyric_font
         # 颜色处理
-        r, g, b = color
-        fill_color = (r, g, b, int(alpha))
+        r, g, b = p.font_color
+        fill_color = (r, g, b, 255)
         
         # 如果需要缩放或模糊，建议先在临时图层绘制再贴回去，或者直接计算坐标
         # 为了性能和效果平衡，这里主要处理位置和Alpha，模糊和缩放通过PIL Image操作
         
         # 计算文字大小
-        bbox = draw.textbbox((0, 0), text, font=font)
+        bbox = self.get_text_bbox(text)
         w = bbox[2] - bbox[0]
         h = bbox[3] - bbox[1]
         
         # 创建临时画布用于处理单行特效（缩放/模糊）
         # 增加padding防止模糊被切
-        padding = 20
+        padding = self.TEXT_PADDING
         temp_w, temp_h = int(w + padding*2), int(h + padding*2)
-        if temp_w <= 0 or temp_h <= 0: return
+        if temp_w <= 0 or temp_h <= 0: return None
 
         txt_img = Image.new('RGBA', (temp_w, temp_h), (0,0,0,0))
         txt_draw = ImageDraw.Draw(txt_img)
@@ -125,126 +241,224 @@ class FrameRenderer:
         # 本地坐标
         lx, ly = padding, padding
         
+        # 文字字形只光栅化一次，阴影和主体共用同一个遮罩
+        glyph_mask = Image.new('L', (temp_w, temp_h), 0)
+        ImageDraw.Draw(glyph_mask).text((lx, ly), text, font=font, fill=255)
+
         # 1. 绘制阴影
-        if shadow['enabled']:
-            sr, sg, sb = shadow['color']
-            s_alpha = int(alpha * 0.6) # 阴影透明度随主透明度降低
+        if p.shadow_enabled:
+            sr, sg, sb = p.shadow_color
+            s_alpha = int(255 * 0.6) # 阴影本身的透明度；行的透明度在 blend_tile 贴图时再乘上去
             s_fill = (sr, sg, sb, s_alpha)
-            txt_draw.text((lx + shadow['x'], ly + shadow['y']), text, font=font, fill=s_fill)
+            txt_img.paste(s_fill, p.shadow_offset, glyph_mask)
 
-        # 2. 绘制描边
-        stroke_width = stroke['width'] if stroke['enabled'] else 0
-        stroke_fill = stroke['color'] + (int(alpha),) if stroke['enabled'] else None
+        # 2. 绘制描边 (描边轮廓比字形大，需要单独光栅化)
+        if p.stroke_enabled:
+            stroke_fill = p.stroke_color + (255,)
+            txt_draw.text((lx, ly), text, font=font, fill=stroke_fill, 
+                          stroke_width=p.stroke_width)
 
         # 3. 绘制主体
-        txt_draw.text((lx, ly), text, font=font, fill=fill_color, 
-                      stroke_width=stroke_width, stroke_fill=stroke_fill)
+        txt_img.paste(fill_color, (0, 0), glyph_mask)
 
         # 4. 处理缩放 (Scale)
         if scale != 1.0:
             new_w = int(temp_w * scale)
             new_h = int(temp_h * scale)
             if new_w > 0 and new_h > 0:
-                txt_img = txt_img.resize((new_w, new_h), resample=Image.Resampling.LANCZOS)
+                # 清晰的行用 LANCZOS；要模糊的行细节反正会被抹掉，用便宜得多的 BILINEAR
+                resample = Image.Resampling.LANCZOS if blur_radius == 0 else Image.Resampling.BILINEAR
+                txt_img = txt_img.resize((new_w, new_h), resample=resample)
         
         # 5. 处理模糊 (Feather/Blur)
         if blur_radius > 0:
-            txt_img = txt_img.filter(ImageFilter.GaussianBlur(radius=blur_radius))
-
-        # 6. 计算最终粘贴位置
+            if p.shadow_enabled or p.stroke_enabled:
+                # 阴影/描边颜色不同，四个通道都要模糊
+                txt_img = txt_img.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+            else:
+                # 单色文字：RGB 恒为文字颜色，只需模糊 Alpha 通道
+                alpha_plane = txt_img.getchannel('A').filter(ImageFilter.GaussianBlur(radius=blur_radius))
+                arr = np.empty((alpha_plane.height, alpha_plane.width, 4), np.uint8)
+                arr[..., :3] = p.font_color
+                arr[..., 3] = np.asarray(alpha_plane)
+                return arr
+
+        return np.asarray(txt_img)
+
+    def get_text_image(self, text, level):
+        """取某行歌词在指定距离等级下的光栅化结果，同一行在同一等级会停留很多帧，命中缓存即可复用"""
+        scale = self.level_scale[level]
+        blur = self.level_blur[level]
+        key = (text, scale, blur)
+        if key in self.glyph_cache:
+            self.glyph_cache.move_to_end(key)
+            return self.glyph_cache[key]
+
+        txt_img = self.rasterize_text(text, scale, blur)
+        self.glyph_cache[key] = txt_img
+        if len(self.glyph_cache) > self.glyph_cache_size:
+            self.glyph_cache.popitem(last=False)
+        return txt_img
+
+    def draw_text_with_effects(self, text, x, y, level):
+        """把带有各种特效的单行文本合成到帧缓冲上"""
+        alpha = self.level_alpha[level]
+        if alpha <= 5: return #太淡了不画
+
+        txt_img = self.get_text_image(text, level)
+        if txt_img is None: return
+
+        # 计算最终粘贴位置
         # 对齐方式修正X
-        final_w, final_h = txt_img.size
+        final_h, final_w = txt_img.shape[:2]
         dest_x = x
-        if align == 'center':
+        if self.align_center:
             dest_x = x - final_w // 2
-        elif align == 'right':
+        elif self.align_right:
             dest_x = x - final_w
         
         dest_y = y - final_h // 2 # 垂直居中绘制
 
-        return txt_img, dest_x, dest_y
-
-    def render(self, current_time):
-        width = self.p['width']
-        height = self.p['height']
+        self.blend_tile(txt_img, int(dest_x), int(dest_y), alpha)
+
+    def blend_tile(self, tile, x, y, alpha):
+        """在帧缓冲上只对相交区域做 Alpha 混合，结果与 Image.paste(tile, box, tile) 一致"""
+        tile_h, tile_w = tile.shape[:2]
+        height, width = self.frame_buf.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + tile_w, width), min(y + tile_h, height)
+        if x0 >= x1 or y0 >= y1: return
+
+        src = tile[y0 - y:y1 - y, x0 - x:x1 - x]
+        dst = self.frame_buf[y0:y1, x0:x1]
+
+        # 所有中间结果都写进 uint16 临时缓冲区，不产生额外的临时数组；
+        # Alpha 预先展开成 4 通道，所有运算都是同形状的逐元素运算
+        shape = (y1 - y0, x1 - x0, 4)
+        a4, src4, tmp = np.empty(shape, np.uint16), np.empty(shape, np.uint16), np.empty(shape, np.uint16)
+
+        # 缓存的图块是完全不透明的，这里只缩放 Alpha 通道
+        np.copyto(a4, src[..., 3:4])
+        if alpha < 255:
+            a4 *= int(alpha)
+            a4 //= 255
+        np.copyto(src4, src)
+        src4[..., 3] = a4[..., 0]
+
+        # (src * a + dst * (255 - a) + 127) // 255
+        src4 *= a4
+        np.subtract(255, a4, out=a4)
+        np.multiply(dst, a4, out=tmp)
+        src4 += tmp
+        src4 += 127
+        src4 //= 255
+        np.copyto(dst, src4, casting='unsafe')
+
+    def layout_header(self):
+        """计算顶部信息和歌词区域的位置，整个导出过程中不变，只算一次"""
+        width = self.p.width
+        height = self.p.height
+        align = self.p.align
         
-        # 创建全透明背景
-        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        
-        # 1. 绘制顶部信息 (Title, Artist, Album)
         margin_top = 40
-        header_x = width // 2 if self.p['align'] == 'center' else (50 if self.p['align'] == 'left' else width - 50)
+        self.header_x = width // 2 if align == 'center' else (50 if align == 'left' else width - 50)
         
         # Title
-        title_w = draw.textlength(self.p['meta_title'], font=self.meta_title_font)
-        tx = header_x - title_w//2 if self.p['align'] == 'center' else (header_x if self.p['align'] == 'left' else header_x - title_w)
-        draw.text((tx, margin_top), self.p['meta_title'], font=self.meta_title_font, fill=self.p['font_color']+(255,))
+        title_w = self.meta_title_font.getlength(self.p.meta_title)
+        tx = self.header_x - title_w//2 if align == 'center' else (self.header_x if align == 'left' else self.header_x - title_w)
+        self.title_pos = (tx, margin_top)
         
         # Info
-        info_text = f"{self.p['meta_artist']} - {self.p['meta_album']}"
-        info_w = draw.textlength(info_text, font=self.meta_info_font)
-        ix = header_x - info_w//2 if self.p['align'] == 'center' else (header_x if self.p['align'] == 'left' else header_x - info_w)
-        draw.text((ix, margin_top + self.p['font_size']*2), info_text, font=self.meta_info_font, fill=self.p['font_color']+(200,))
+        self.info_text = f"{self.p.meta_artist} - {self.p.meta_album}"
+        info_w = self.meta_info_font.getlength(self.info_text)
+        ix = self.header_x - info_w//2 if align == 'center' else (self.header_x if align == 'left' else self.header_x - info_w)
+        self.info_pos = (ix, margin_top + self.p.font_size*2)
+
+        # 顶部信息占用的行数 (只有这一条带状区域需要每帧恢复)
+        title_bottom = self.title_pos[1] + self.meta_title_font.getbbox(self.p.meta_title)[3]
+        info_bottom = self.info_pos[1] + self.meta_info_font.getbbox(self.info_text)[3]
+        self.header_height = max(0, min(height, int(max(title_bottom, info_bottom)) + 1))
 
         # 2. 歌词滚动区域计算
-        scroll_area_top = margin_top + self.p['font_size'] * 4
+        scroll_area_top = margin_top + self.p.font_size * 4
         scroll_area_height = height - scroll_area_top - 50
-        center_y = scroll_area_top + scroll_area_height // 2
+        self.center_y = scroll_area_top + scroll_area_height // 2
+
+    def render_header(self):
+        """绘制顶部信息 (Title, Artist, Album)，返回只包含顶部带状区域的 RGBA 数组"""
+        # 创建全透明背景
+        img = Image.new('RGBA', (self.p.width, max(1, self.header_height)), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        
+        draw.text(self.title_pos, self.p.meta_title, font=self.meta_title_font, fill=self.p.font_color+(255,))
+        draw.text(self.info_pos, self.info_text, font=self.meta_info_font, fill=self.p.font_color+(200,))
+
+        return np.array(img)[:self.header_height]
+
+    def plan_lines(self):
+        """预先算好每个可见槽位 (相对当前行的偏移) 的距离等级和 Y 坐标。
+        行的位置只取决于它与当前行的距离，与时间无关，画面外的槽位在这里一次性剔除"""
+        p = self.p
+        self.align_center = p.align == 'center'
+        self.align_right = p.align == 'right'
+
+        # 绘制顺序：中心行，然后由近到远，每一级先上方后下方
+        offsets = np.arange(1, self.max_level + 1)
+        offsets = np.concatenate(([0], np.stack((-offsets, offsets), axis=1).ravel()))
+        levels = np.abs(offsets)
+        y_pos = self.center_y + offsets * (p.font_size + p.line_spacing)
+
+        # 整行都在画面外就跳过，不做任何光栅化
+        extent = (p.font_size + self.TEXT_PADDING * 2) * np.asarray(self.level_scale)[levels]
+        visible = (y_pos + extent >= 0) & (y_pos - extent <= p.height)
+        self.plan = list(zip(offsets[visible].tolist(), levels[visible].tolist(), y_pos[visible].tolist()))
+
+    def render(self, current_time):
+        """渲染一帧，返回 (H, W, 4) 的 RGBA uint8 帧缓冲；缓冲会在下一次调用时被复用"""
+        # 清空帧缓冲，只把顶部信息所在的带状区域拷回去
+        self.frame_buf.fill(0)
+        self.frame_buf[:self.header_height] = self.header_buf
         
         # 找到当前行
         curr_idx = self.get_current_line_index(current_time)
         
-        # 平滑滚动计算 (Optional: Calculate offset based on time progress within line)
         # 简单模式：当前行永远在C位，不随时间微移，直接居中
-        # 复杂模式：如果在两行之间，可以做插值。为了模仿Apple Music，当前行高亮且居中，切换时有动画。
-        # 这里简化：当前行绝对居中。
-        
-        # 绘制歌词
-        # 向上和向下遍历
-        visible_lines = self.p['visible_lines']
-        line_spacing = self.p['line_spacing']
-        
-        # 渲染列表：包含 (index, distance_level)
-        render_list = []
-        render_list.append((curr_idx, 0)) # 中心行
-        
-        for i in range(1, visible_lines // 2 + 2):
-            if curr_idx - i >= 0: render_list.append((curr_idx - i, -i)) # 上方
-            if curr_idx + i < len(self.lyrics): render_list.append((curr_idx + i, i)) # 下方
+        # 槽位的等级和位置已由 plan_lines 算好，这里只需把歌词行号对上
+        lyrics = self.lyrics
+        num_lines = len(lyrics)
+        header_x = self.header_x
+        for offset, level, y_pos in self.plan:
+            idx = curr_idx + offset
+            if 0 <= idx < num_lines:
+                self.draw_text_with_effects(lyrics[idx]['text'], header_x, y_pos, level)
 
-        for idx, dist_level in render_list:
-            if idx < 0 or idx >= len(self.lyrics): continue
-            
-            line_text = self.lyrics[idx]['text']
-            abs_dist = abs(dist_level)
-            
-            # 计算参数
-            # 系数递增：base + (coeff * abs_dist)
-            scale = max(0.1, 1.0 - (self.p['scale_decay'] * abs_dist))
-            
-            # 透明度
-            alpha = max(0, 255 - (self.p['fade_decay'] * abs_dist * 50)) 
-            if dist_level == 0: alpha = 255 # 当前行完全不透明
-            
-            # 羽化/模糊
-            blur = self.p['blur_base'] + (self.p['blur_inc'] * abs_dist)
-            if dist_level == 0: blur = 0 # 当前行清晰
-            
-            # Y坐标计算
-            y_pos = center_y + (dist_level * (self.p['font_size'] + line_spacing))
-            
-            # 绘制
-            res_img, dx, dy = self.draw_text_with_effects(
-                draw, line_text, header_x, y_pos, 
-                self.lyric_font, self.p['font_color'], alpha, scale, blur, 
-                self.p['align'], self.p['shadow'], self.p['stroke']
-            )
-            
-            if res_img:
-                img.paste(res_img, (int(dx), int(dy)), res_img)
+        return self.frame_buf
 
-        return img
+# -----------------------------------------------------------------------------
+# 多进程渲染：每个工作进程持有自己的 FrameRenderer
+# -----------------------------------------------------------------------------
+_worker_renderer = None
+_worker_shm = None
+_worker_frames = None
+
+def _init_render_worker(params, lyrics, shm_name, num_slots):
+    """工作进程初始化：只传递参数和歌词，字体在子进程内加载（FreeType 对象无法跨进程传递）
+    渲染结果写入主进程创建的共享内存环形缓冲，不再经过 pickle/管道回传"""
+    global _worker_renderer, _worker_shm, _worker_frames
+    # 渲染器自带的帧缓冲不会被写入 (np.zeros 的页在写入前不占物理内存)，实际渲染直接画在共享内存的槽位上
+    _worker_renderer = FrameRenderer(params, lyrics)
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_frames = np.ndarray((num_slots,) + _worker_renderer.frame_buf.shape,
+                                dtype=np.uint8, buffer=_worker_shm.buf)
+
+def _render_frames_worker(start, count, fps):
+    """在工作进程中渲染从第 start 帧开始的连续 count 帧。
+    第 n 帧直接画在共享内存的第 n % 槽位数 个槽位上，不再整帧拷贝一次"""
+    num_slots = len(_worker_frames)
+    for n in range(start, start + count):
+        _worker_renderer.frame_buf = _worker_frames[n % num_slots]
+        _worker_renderer.render(n / fps)
+    return start, count
 
 # -----------------------------------------------------------------------------
 # 导出线程
@@ -254,6 +468,11 @@ class ExportThread(QThread):
     finished_signal = pyqtSignal(str)
     error_signal = pyqtSignal(str)
 
+    # 共享内存环形缓冲的字节上限，与核心数无关
+    FRAME_BUFFER_BUDGET = 512 * 1024 * 1024
+    # 每个渲染任务最多包含的连续帧数 (约一行歌词的时长)
+    FRAMES_PER_TASK = 60
+
     def __init__(self, params, lyrics, output_path):
         super().__init__()
         self.params = params
@@ -271,19 +490,23 @@ class ExportThread(QThread):
 
             # FFmpeg 命令: ProRes 4444 (ap4h) 支持 Alpha 通道
             # -pix_fmt yuva444p10le 是关键
+            # RGBA -> YUVA 转换放进滤镜图并开启滤镜多线程，编码器也用满所有核心
             ffmpeg_path = get_ffmpeg_path() 
             cmd = [
                 ffmpeg_path,
                 '-y', # 覆盖输出
+                '-filter_threads', str(os.cpu_count() or 1),
                 '-f', 'rawvideo',
                 '-vcodec', 'rawvideo',
                 '-s', f'{width}x{height}',
                 '-pix_fmt', 'rgba',
                 '-r', str(fps),
                 '-i', '-', # 从管道输入
+                '-vf', 'format=yuva444p10le',
                 '-c:v', 'prores_ks', 
                 '-profile:v', '4444', # ProRes 4444 for Alpha
                 '-pix_fmt', 'yuva444p10le', # 10bit alpha
+                '-threads', '0',
                 '-b:v', self.params['bitrate'],
                 self.output_path
             ]
@@ -302,23 +525,85 @@ class ExportThread(QThread):
                 startupinfo=startupinfo
             )
 
-            renderer = FrameRenderer(self.params, self.lyrics)
-
-            for i in range(total_frames):
-                if not self.is_running:
-                    process.stdin.close()
-                    process.wait()
-                    return
-
-                t = i / fps
-                img = renderer.render(t)
-                
-                # 转换为bytes
-                process.stdin.write(img.tobytes())
-                
-                # 更新进度
-                if i % 10 == 0:
-                    self.progress_signal.emit(int((i / total_frames) * 100))
+            # Linux 下加大管道缓冲，让 FFmpeg 能一次吸收多帧，减少渲染端被阻塞
+            if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+                pipe_size = 8 * 1024 * 1024
+                try:
+                    with open('/proc/sys/fs/pipe-max-size') as f:
+                        pipe_size = min(pipe_size, int(f.read()))
+                    fcntl.fcntl(process.stdin.fileno(), fcntl.F_SETPIPE_SZ, pipe_size)
+                except (OSError, ValueError):
+                    pass # 调整失败就用系统默认大小
+
+            # 帧与帧之间互不依赖，分给多个进程并行渲染；按提交顺序取结果写入管道
+            workers = max(1, min(os.cpu_count() or 1, total_frames))
+            # 槽位数先按字节预算定，再按核心数定：8K RGBA 一帧就有 ~133MB，不能随核心数增长
+            frame_size = width * height * 4
+            budget_frames = max(3, self.frame_buffer_budget() // frame_size)
+            # 预算同时覆盖 在途帧 + 队列 (渲染线程与写管道之间的缓冲) + 正在写的 1 帧；
+            # 预算紧张时队列和在途帧数对半分
+            queue_size = max(1, min(4, (budget_frames - 1) // 2))
+            render_frames = budget_frames - queue_size - 1
+            # 每个任务渲染一段连续的帧：同一行歌词的各个距离等级只在少数进程里光栅化，
+            # 而不是每个进程都把整首歌光栅化一遍。在途帧数 = 在途任务数 x 每个任务的帧数
+            chunk = max(1, min(self.FRAMES_PER_TASK, render_frames // workers))
+            max_in_flight = max(1, min(workers * 2, render_frames // chunk))
+            workers = min(workers, max_in_flight)
+
+            # 共享内存环形缓冲，第 n 帧固定使用第 n % num_slots 个槽位。
+            # 提交新任务时，尚未写完的帧最多有 在途任务 (含新任务) + 队列中 + 正在写 共 num_slots 帧，
+            # 且是连续的一段，所以槽位不会被提前覆盖
+            num_slots = max_in_flight * chunk + queue_size + 1
+            shm = shared_memory.SharedMemory(create=True, size=frame_size * num_slots)
+            frames = memoryview(shm.buf)
+            try:
+                with ProcessPoolExecutor(max_workers=workers,
+                                         initializer=_init_render_worker,
+                                         initargs=(self.params, self.lyrics, shm.name, num_slots)) as executor:
+                    # 渲染放在生产者线程，当前线程只负责写管道：
+                    # 写入因 FFmpeg 反压阻塞时，后续帧的提交和收集照常进行
+                    frame_queue = queue.Queue(maxsize=queue_size)
+                    abort = threading.Event()
+                    producer = threading.Thread(
+                        target=self._render_loop,
+                        args=(executor, total_frames, fps, chunk, max_in_flight, num_slots, frame_queue, abort),
+                        daemon=True
+                    )
+                    producer.start()
+
+                    producer_done = False
+                    try:
+                        for i in range(total_frames):
+                            slot = frame_queue.get()
+                            if slot is None: # 生产者已结束 (被取消)
+                                producer_done = True
+                                break
+                            if isinstance(slot, Exception):
+                                raise slot
+
+                            # 直接把共享内存中的帧写入管道，不再生成中间 bytes
+                            process.stdin.write(frames[slot * frame_size:(slot + 1) * frame_size])
+
+                            # 更新进度
+                            if i % 10 == 0:
+                                self.progress_signal.emit(int((i / total_frames) * 100))
+                    finally:
+                        # 通知生产者退出，并清空队列直到收到结束标记，避免它卡在 put 上
+                        abort.set()
+                        while not producer_done:
+                            producer_done = frame_queue.get() is None
+                        producer.join()
+            finally:
+                frames.release()
+                shm.close()
+                shm.unlink()
+
+            # 被取消：此时工作进程已全部退出 (fork 出的子进程会继承管道句柄，
+            # 它们不退出 FFmpeg 就收不到 EOF)
+            if not self.is_running:
+                process.stdin.close()
+                process.wait()
+                return
 
             process.stdin.close()
             process.wait()
@@ -332,6 +617,44 @@ class ExportThread(QThread):
         except Exception as e:
             self.error_signal.emit(str(e))
 
+    def frame_buffer_budget(self):
+        """环形缓冲可用的字节数。Linux 上共享内存放在 /dev/shm，还要受它的剩余空间限制 (Docker 默认只有 64MB)"""
+        budget = self.FRAME_BUFFER_BUDGET
+        try:
+            budget = min(budget, shutil.disk_usage('/dev/shm').free * 3 // 4)
+        except OSError:
+            pass # Windows/macOS 没有 /dev/shm
+        return budget
+
+    def _render_loop(self, executor, total_frames, fps, chunk, max_in_flight, num_slots, frame_queue, abort):
+        """生产者：按顺序提交渲染任务 (每个任务 chunk 帧)，把渲染完成的槽位号依次放入队列，最后放入 None 作为结束标记"""
+        pending = deque()
+
+        def put_frames(future):
+            start, count = future.result()
+            for n in range(start, start + count):
+                frame_queue.put(n % num_slots)
+
+        try:
+            for start in range(0, total_frames, chunk):
+                if not self.is_running or abort.is_set():
+                    return
+                count = min(chunk, total_frames - start)
+                pending.append(executor.submit(_render_frames_worker, start, count, fps))
+                if len(pending) >= max_in_flight:
+                    put_frames(pending.popleft())
+
+            while pending:
+                if not self.is_running or abort.is_set():
+                    return
+                put_frames(pending.popleft())
+        except Exception as e:
+            frame_queue.put(e)
+        finally:
+            for future in pending:
+                future.cancel()
+            frame_queue.put(None)
+
     def stop(self):
         self.is_running = False
 
@@ -369,7 +692,8 @@ class MainWindow(QMainWindow):
             'stroke': {'enabled': False, 'color': (0,0,0), 'width': 2}
         }
         self.lyrics = []
-        self.renderer = None
+        self.renderer = None # 预览用的渲染器，参数不变时复用
+        self.preview_frame = None
 
         self.init_ui()
 
@@ -715,24 +1039,25 @@ class MainWindow(QMainWindow):
         current_time = self.slider_time.value() / 100.0
         self.lbl_time.setText(f"{int(current_time//60):02d}:{int(current_time%60):02d}")
         
+        # 预览直接按预览区大小渲染，省掉 Qt 的二次缩放
         current_params = self.get_ui_params()
-        # 预览降低分辨率以提高速度
-        preview_scale = 0.5
-        current_params['width'] = int(current_params['width'] * preview_scale)
-        current_params['height'] = int(current_params['height'] * preview_scale)
-        current_params['font_size'] = int(current_params['font_size'] * preview_scale)
-        current_params['line_spacing'] = int(current_params['line_spacing'] * preview_scale)
-        
-        renderer = FrameRenderer(current_params, self.lyrics)
-        pil_image = renderer.render(current_time)
-        
-        # PIL to QPixmap
-        im_data = pil_image.convert("RGBA").tobytes("raw", "RGBA")
-        qim = QImage(im_data, pil_image.width, pil_image.height, QImage.Format.Format_RGBA8888)
+        label_size = self.preview_label.contentsRect().size()
+        current_params['render_scale'] = min(label_size.width() / current_params['width'],
+                                             label_size.height() / current_params['height'])
+        render_params = RenderParams.from_dict(current_params)
+        
+        # 只拖动时间轴时参数不变，复用同一个渲染器 (帧缓冲和字形缓存都能沿用)
+        if self.renderer is None or self.renderer.p != render_params or self.renderer.lyrics is not self.lyrics:
+            self.renderer = FrameRenderer(render_params, self.lyrics)
+        frame = self.renderer.render(current_time)
+        
+        # RGBA 帧缓冲 to QPixmap (零拷贝包装，需保留数组引用，避免 Qt 读到已释放的内存)
+        self.preview_frame = frame
+        qim = QImage(frame.data, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format.Format_RGBA8888)
         pix = QPixmap.fromImage(qim)
         
-        # Fit to label
-        self.preview_label.setPixmap(pix.scaled(self.preview_label.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
+        # 已经是预览区大小，无需再缩放
+        self.preview_label.setPixmap(pix)
 
     def start_export(self):
         if not self.lyrics:
@@ -762,6 +1087,8 @@ class MainWindow(QMainWindow):
         QMessageBox.critical(self, "Error", msg)
 
 if __name__ == '__main__':
+    # 打包后 (PyInstaller) 的多进程导出需要
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     
     # 设置深色主题风格